@@ -2,11 +2,15 @@
 
 import argparse
 import datetime
+import fcntl
 import glob
 import json
 import os
 import re
+import socket
 import subprocess
+import sys
+import time
 import uuid
 
 
@@ -51,6 +55,56 @@ def exclude_inputs(context, inputs, exclusion_criteria):
     return context, selected_inputs
 
 
+def claim_lease(lease_dir, generator_name, run_id, lease_duration_seconds):
+    """
+    Claim a lease on a run for this generator, so that overlapping invocations don't emit duplicate commands for it.
+    Leases are stored as json files in lease_dir, and expire after lease_duration_seconds.
+    Returns False if another invocation holds an unexpired lease on the run.
+    input: "/path/to/leases", "routine_sequence_qc", "201228_M00325_0168_000000000-G67AT", 3600
+    output: True
+    """
+    os.makedirs(lease_dir, exist_ok=True)
+    lease_path = os.path.join(lease_dir, generator_name + "." + run_id + ".lease.json")
+    lock_path = os.path.join(lease_dir, generator_name + ".lock")
+
+    # Hold a lock while checking and replacing the lease, so two invocations can't both see it as expired
+    with open(lock_path, 'a') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            # Expiry is stored as epoch seconds, so it compares correctly across hosts, time zones and DST changes
+            now = time.time()
+            if os.path.exists(lease_path):
+                try:
+                    with open(lease_path, 'r') as f:
+                        lease = json.load(f)
+                    if float(lease['lease_expires_epoch_seconds']) > now:
+                        return False
+                except (ValueError, KeyError, TypeError) as e:
+                    print("Treating unreadable lease " + lease_path + " as expired: " + repr(e), file=sys.stderr)
+
+            lease = {
+                "lease_id": str(uuid.uuid4()),
+                "generator": generator_name,
+                "run_id": run_id,
+                "hostname": socket.gethostname(),
+                "pid": os.getpid(),
+                "lease_claimed_epoch_seconds": now,
+                "lease_expires_epoch_seconds": now + lease_duration_seconds,
+            }
+            tmp_lease_path = lease_path + "." + lease['lease_id'] + ".tmp"
+            try:
+                with open(tmp_lease_path, 'w') as f:
+                    json.dump(lease, f)
+                os.replace(tmp_lease_path, lease_path)
+            finally:
+                if os.path.exists(tmp_lease_path):
+                    os.remove(tmp_lease_path)
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    return True
+
+
 def main(args):
 
     with open(args.config, 'r') as f:
@@ -85,6 +139,9 @@ def main(args):
     
     for i in selected_inputs:
         run_id = os.path.basename(i)
+        if args.lease_dir and not claim_lease(args.lease_dir, "routine_sequence_qc", run_id, args.lease_duration):
+            print("Skipping run " + run_id + ": leased by another invocation (see " + args.lease_dir + ")", file=sys.stderr)
+            continue
         message_id = str(uuid.uuid4())
         message["message_id"] = message_id
         if 'correlation_id' not in message or not message['correlation_id']:
@@ -136,6 +193,8 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
     parser.add_argument("-i", "--input-parent-dir", required=True, help="Parent directory under which input directories are stored")
     parser.add_argument("-c", "--config", required=True, help="JSON-formatted template for pipeline configurations")
+    parser.add_argument("--lease-dir", help="Directory in which to store per-run leases. If set, runs leased by another invocation are skipped")
+    parser.add_argument("--lease-duration", type=int, default=3600, help="Number of seconds before a run's lease expires")
     parser.add_argument("-a", "--after", help="Earliest date of run to analyze.")
     parser.add_argument("-b", "--before", help="Latest date of run to analyze.")
     args = parser.parse_args()
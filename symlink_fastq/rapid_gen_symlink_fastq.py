@@ -2,11 +2,16 @@
 
 import argparse
 import datetime
+import fcntl
 import glob
 import json
 import os
 import re
+import shlex
+import socket
 import subprocess
+import sys
+import time
 import uuid
 
 
@@ -68,6 +73,106 @@ def get_experiment_name(sample_sheet_path):
     return experiment_name
 
 
+def parse_fastq_filename(fastq_path):
+    """
+    Parse an Illumina (bcl2fastq) fastq filename into its fields. Returns None if the filename isn't lane-split Illumina format.
+    input: "/path/to/Sample-1_S1_L001_R1_001.fastq.gz"
+    output: {"sample": "Sample-1", "sample_number": 1, "lane": 1, "read": "R1", "chunk": 1}
+    """
+    match = re.match(r'^(.+)_S(\d+)_L(\d{3})_([RI]\d)_(\d{3})\.fastq\.gz$', os.path.basename(fastq_path))
+    if not match:
+        return None
+    sample, sample_number, lane, read, chunk = match.groups()
+    return {"sample": sample, "sample_number": int(sample_number), "lane": int(lane), "read": read, "chunk": int(chunk)}
+
+
+def group_fastqs(fastq_paths, rename_fn):
+    """
+    Index fastq files by the destination filename that rename_fn maps them to, so that collisions can be found up front.
+    Groups whose members all parse as Illumina fastqs are sorted by lane (then chunk), otherwise by path.
+    input: ["/path/to/Sample-1_S1_L002_R1_001.fastq.gz", "/path/to/Sample-1_S1_L001_R1_001.fastq.gz", ...], lambda f: ...
+    output: {"Sample-1_R1.fastq.gz": ["/path/to/Sample-1_S1_L001_R1_001.fastq.gz", "/path/to/Sample-1_S1_L002_R1_001.fastq.gz"], ...}
+    """
+    grouped_fastqs = {}
+    for fastq_path in fastq_paths:
+        destination = rename_fn(os.path.basename(fastq_path))
+        grouped_fastqs.setdefault(destination, []).append(fastq_path)
+
+    for destination, paths in grouped_fastqs.items():
+        parsed_filenames = [parse_fastq_filename(p) for p in paths]
+        if all(parsed_filenames):
+            grouped_fastqs[destination] = [p for _, p in sorted(zip([(f['lane'], f['chunk']) for f in parsed_filenames], paths))]
+        else:
+            grouped_fastqs[destination] = sorted(paths)
+
+    return grouped_fastqs
+
+
+def is_lane_split(fastq_paths):
+    """
+    Check that a group of fastqs are lanes (and/or chunks) of a single sample/read, and so can be safely merged.
+    Files that differ in sample name, sample number (S1 vs S12) or read (R1 vs R2) are not lane-split.
+    input: ["/path/to/Sample-1_S1_L001_R1_001.fastq.gz", "/path/to/Sample-1_S1_L002_R1_001.fastq.gz"]
+    output: True
+    """
+    parsed_filenames = [parse_fastq_filename(p) for p in fastq_paths]
+    if not all(parsed_filenames):
+        return False
+    sample_reads = set([(f['sample'], f['sample_number'], f['read']) for f in parsed_filenames])
+
+    return len(sample_reads) == 1
+
+
+def claim_lease(lease_dir, generator_name, run_id, lease_duration_seconds):
+    """
+    Claim a lease on a run for this generator, so that overlapping invocations don't emit duplicate commands for it.
+    Leases are stored as json files in lease_dir, and expire after lease_duration_seconds.
+    Returns False if another invocation holds an unexpired lease on the run.
+    input: "/path/to/leases", "symlink_fastq", "201228_M00325_0168_000000000-G67AT", 3600
+    output: True
+    """
+    os.makedirs(lease_dir, exist_ok=True)
+    lease_path = os.path.join(lease_dir, generator_name + "." + run_id + ".lease.json")
+    lock_path = os.path.join(lease_dir, generator_name + ".lock")
+
+    # Hold a lock while checking and replacing the lease, so two invocations can't both see it as expired
+    with open(lock_path, 'a') as lock_file:
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        try:
+            # Expiry is stored as epoch seconds, so it compares correctly across hosts, time zones and DST changes
+            now = time.time()
+            if os.path.exists(lease_path):
+                try:
+                    with open(lease_path, 'r') as f:
+                        lease = json.load(f)
+                    if float(lease['lease_expires_epoch_seconds']) > now:
+                        return False
+                except (ValueError, KeyError, TypeError) as e:
+                    print("Treating unreadable lease " + lease_path + " as expired: " + repr(e), file=sys.stderr)
+
+            lease = {
+                "lease_id": str(uuid.uuid4()),
+                "generator": generator_name,
+                "run_id": run_id,
+                "hostname": socket.gethostname(),
+                "pid": os.getpid(),
+                "lease_claimed_epoch_seconds": now,
+                "lease_expires_epoch_seconds": now + lease_duration_seconds,
+            }
+            tmp_lease_path = lease_path + "." + lease['lease_id'] + ".tmp"
+            try:
+                with open(tmp_lease_path, 'w') as f:
+                    json.dump(lease, f)
+                os.replace(tmp_lease_path, lease_path)
+            finally:
+                if os.path.exists(tmp_lease_path):
+                    os.remove(tmp_lease_path)
+        finally:
+            fcntl.lockf(lock_file, fcntl.LOCK_UN)
+
+    return True
+
+
 def main(args):
 
     with open(args.config, 'r') as f:
@@ -109,6 +214,29 @@ def main(args):
         correlation_id = str(uuid.uuid4())
         run_id = os.path.basename(i)
         experiment_name = get_experiment_name(os.path.join(i, 'SampleSheet.csv'))
+
+        miseq_fastq_dir_path = os.path.join("Data", "Intensities", "BaseCalls")
+        nextseq_analysis_number = 1
+        nextseq_fastq_dir_path = os.path.join("Analysis", str(nextseq_analysis_number), "Data", "fastq")
+
+        fastq_glob = os.path.join(os.path.abspath(i), miseq_fastq_dir_path, "*.fastq.gz")
+        fastq_paths = glob.glob(fastq_glob)
+        grouped_fastqs = group_fastqs(fastq_paths, rename_fn)
+
+        # Multiple fastqs that map to the same destination would overwrite each other's symlinks
+        colliding_destinations = sorted([d for d, paths in grouped_fastqs.items() if len(paths) > 1])
+        unmergeable_destinations = [d for d in colliding_destinations if not is_lane_split(grouped_fastqs[d])]
+        if unmergeable_destinations:
+            print("Skipping run " + run_id + ": fastqs that are not lanes of the same sample/read map to the same destination (" + ", ".join(unmergeable_destinations) + "). Check the SampleSheet and fastq filenames.", file=sys.stderr)
+            continue
+        elif colliding_destinations and not args.merge_lanes:
+            print("Skipping run " + run_id + ": lane-split fastqs map to the same destination (" + ", ".join(colliding_destinations) + "). Re-run with --merge-lanes to merge them.", file=sys.stderr)
+            continue
+
+        if args.lease_dir and not claim_lease(args.lease_dir, "symlink_fastq", run_id, args.lease_duration):
+            print("Skipping run " + run_id + ": leased by another invocation (see " + args.lease_dir + ")", file=sys.stderr)
+            continue
+
         if args.output_parent_dir:
             message['command_invocation_directory'] = os.path.abspath(os.path.join(args.output_parent_dir, os.path.basename(i)))
         elif args.output_dir:
@@ -131,24 +259,46 @@ def main(args):
             print(json.dumps(message))
             message = stashed_message
 
-        miseq_fastq_dir_path = os.path.join("Data", "Intensities", "BaseCalls")
-        nextseq_analysis_number = 1
-        nextseq_fastq_dir_path = os.path.join("Analysis", str(nextseq_analysis_number), "Data", "fastq")
+        for _, paths in sorted(grouped_fastqs.items()):
+            context['source'] = paths[0]
+            destination = generate_destination(context)
 
-        fastq_glob = os.path.join(os.path.abspath(i), miseq_fastq_dir_path, "*.fastq.gz")
-        fastq_paths = glob.glob(fastq_glob)
+            if len(paths) > 1:
+                # Concatenated gzip members are themselves a valid gzip file, so lanes can be merged without recompressing
+                # Record the exact sources (path, size, mtime) of each merged fastq in a sidecar file, and only skip the merge
+                # when the sidecar matches, so re-sent runs don't re-copy every lane but other runs' or re-demultiplexed fastqs are never reused
+                source_manifest = '\n'.join(['\t'.join([p, str(os.stat(p).st_size), str(os.stat(p).st_mtime)]) for p in paths])
+                quoted_source_manifest = shlex.quote(source_manifest)
+                quoted_destination = shlex.quote(destination)
+                quoted_tmp_destination = shlex.quote(destination + '.tmp')
+                quoted_sources_destination = shlex.quote(destination + '.sources')
+                merge_command = '{ [ -f ' + quoted_destination + ' ] && [ ! -L ' + quoted_destination + ' ] && [ "$(cat ' + quoted_sources_destination + ' 2>/dev/null)" = ' + quoted_source_manifest + ' ]; } || '
+                merge_command += '{ ' + ' '.join(['rm', '-f', quoted_sources_destination])
+                merge_command += ' && ' + ' '.join(['cat'] + [shlex.quote(p) for p in paths] + ['>', quoted_tmp_destination])
+                merge_command += ' && ' + ' '.join(['mv', '-f', quoted_tmp_destination, quoted_destination])
+                merge_command += ' && ' + ' '.join(['printf', "'%s'", quoted_source_manifest, '>', quoted_sources_destination]) + '; }'
+                merge_message = {}
+                merge_message["message_id"] = str(uuid.uuid4())
+                merge_message["message_type"] = "command_creation"
+                merge_message["correlation_id"] = correlation_id
+                merge_message["metadata_context"] = {}
+                merge_message["metadata_context"]["run_id"] = run_id
+                merge_message["metadata_context"]["experiment_name"] = experiment_name
+                merge_message['base_command'] = "sh"
+                merge_message['flags'] = ["-c"]
+                merge_message['positional_arguments'] = [merge_command]
+                merge_message['command_invocation_directory'] = message['command_invocation_directory']
+                merge_message['timestamp_command_created'] = datetime.datetime.now().isoformat()
+                print(json.dumps(merge_message))
+                continue
 
-        for fastq_path in fastq_paths:
             message["message_id"] = str(uuid.uuid4())
             message["message_type"] = "command_creation"
             message['correlation_id'] = correlation_id
             message["metadata_context"] = {}
             message["metadata_context"]["run_id"] = run_id
             message["metadata_context"]["experiment_name"] = experiment_name
-            context['source'] = fastq_path
-            message['positional_arguments'] = [fastq_path]
-
-            destination = generate_destination(context)
+            message['positional_arguments'] = [paths[0]]
             message['positional_arguments'].append(destination)
         
             message['timestamp_command_created'] = datetime.datetime.now().isoformat()
@@ -171,6 +321,9 @@ if __name__ == '__main__':
     parser.add_argument("-o", "--output-parent-dir", help="Parent directory under which symlinks will be created")
     parser.add_argument("--output-dir", help="Directory in which symlinks will be created")
     parser.add_argument("-c", "--config", required=True, help="JSON-formatted template for pipeline configurations")
+    parser.add_argument("--lease-dir", help="Directory in which to store per-run leases. If set, runs leased by another invocation are skipped")
+    parser.add_argument("--lease-duration", type=int, default=3600, help="Number of seconds before a run's lease expires")
+    parser.add_argument("--merge-lanes", action="store_true", help="Merge lane-split fastqs for the same sample and read into a single fastq. Merged fastqs are real files (copies of the data), not symlinks, with a .sources file recording the fastqs they were merged from. Without this, runs with lane-split fastqs are skipped entirely (no symlinks and no symlinks_complete.json sentinel) and only reported on stderr")
     parser.add_argument("-b", "--before", default="1970-01-01", help="Earliest date of run to analyze.")
     parser.add_argument("-a", "--after", default="1970-01-01", help="Earliest date of run to analyze.")
     args = parser.parse_args()